@@ -1,6 +1,10 @@
-import pickle
+import bisect
 import difflib
+import functools
+import json
 import pathlib
+import sqlite3
+import threading
 import zlib
 
 import idaapi
@@ -11,41 +15,66 @@ from PyQt5 import QtWidgets
 
 
 USE_CACHE = True
+DOC_CACHE_SIZE = 128
 DOC_DB_PATH = pathlib.Path(__file__).parent / 'msdn.db'
 HOTKEY = 'Ctrl-Shift-B'
+MIN_PREFIX_LENGTH = 4
+SHORTLIST_CUTOFF = 0.95
+SHORTLIST_SIZE = 3
+NAME_PREFIXES = (ida_name.FUNC_IMPORT_PREFIX, 'cs:', 'ds:', 'j_')
 
 
 class DocsDBView(object):
     def __init__(self, filepath: str, use_cache: bool = True):
         self.use_cache = use_cache
-        self._data = {}
         self._keys = {}
         if not pathlib.Path(filepath).exists():
             raise FileNotFoundError('Database file not found')
-        self._filepath = filepath
-
-    def data(self) -> dict:
-        if not self._data:
-            with open(self._filepath, 'rb') as handle:
-                self._data = pickle.load(handle)
-        return self._data
+        # the plugin loads keys on a background thread, later lookups run on the UI thread
+        self._conn = sqlite3.connect(
+            pathlib.Path(filepath).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False
+        )
+        # read pages straight from the mapped file instead of copying them into sqlite page cache
+        self._conn.execute(f'PRAGMA mmap_size = {pathlib.Path(filepath).stat().st_size}')
+        # preset dictionary shared by all docs, see train_dictionary() in utils/build.py
+        meta = dict(self._conn.execute('SELECT key, value FROM meta'))
+        self._zdict = meta['zdict']
+        # lines interned at build time, placeholder -> line
+        self._fragments = json.loads(zlib.decompress(meta['fragments']))
+        if use_cache:
+            # recently viewed docs are served without touching the database
+            self._decompress = functools.lru_cache(maxsize=DOC_CACHE_SIZE)(self._decompress)
 
     def __getitem__(self, key: str) -> str:
-        value = bytes(self.data()[key])
-        if not self.use_cache:
-            self._data.clear()
-        return zlib.decompress(value).decode()
+        return self._decompress(key)
+
+    def _fetch_compressed(self, key: str) -> bytes:
+        row = self._conn.execute(
+            'SELECT blob FROM docs JOIN blobs ON blobs.id = docs.blob_id WHERE docs.name = ?', (key,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
 
-    def keys(self) -> set:
-        if not self._keys:
-            self._keys = set(self.data())
-            if not self.use_cache:
-                self._cache.clear()
-        return self._keys       
+    def _decompress(self, key: str) -> str:
+        decompressor = zlib.decompressobj(zdict=self._zdict)
+        text = decompressor.decompress(self._fetch_compressed(key)).decode()
+        return '\n'.join([self._fragments.get(line, line) for line in text.split('\n')])
+
+    def keys(self, aliases: bool = True) -> frozenset:
+        if aliases in self._keys:
+            return self._keys[aliases]
+
+        query = 'SELECT name FROM docs' if aliases else 'SELECT name FROM docs WHERE NOT alias'
+        keys = frozenset(name for name, in self._conn.execute(query))
+        if self.use_cache:
+            self._keys[aliases] = keys
+        return keys
 
 
 class MSDN(idaapi.PluginForm):
     widget_name = 'MSDN Docs'
+    widget = None
     options = (
         ida_kernwin.PluginForm.WOPN_MENU
         | ida_kernwin.PluginForm.WOPN_ONTOP
@@ -56,6 +85,7 @@ class MSDN(idaapi.PluginForm):
 
     def OnCreate(self, form):
         self.closed = False
+        self.widget = form
         self.parent = self.FormToPyQtWidget(form)
         self.main_layout = QtWidgets.QVBoxLayout()
         self.markdown_viewer_label = QtWidgets.QLabel()
@@ -66,6 +96,7 @@ class MSDN(idaapi.PluginForm):
         
     def OnClose(self, form):
         del form
+        self.widget = None
         self.closed = True
 
     def Show(self):
@@ -115,20 +146,47 @@ class MSDNPlugin(ida_idaapi.plugin_t):
         except FileNotFoundError as e:
             ida_kernwin.msg(f'{e}\n')
             return idaapi.PLUGIN_SKIP
+        except (sqlite3.Error, KeyError) as e:
+            ida_kernwin.msg(f'failed to open {DOC_DB_PATH}: {e}\n')
+            return idaapi.PLUGIN_SKIP
 
-        self.cache = set(self.db.keys())
+        # name indexes are built off the UI thread to keep IDA startup fast
+        self.cache = set()
+        self.cache_lower = {}
+        self.prefix_index = []
+        self._loaded = False
+        self._ready = threading.Event()
+        threading.Thread(target=self._load_db, daemon=True).start()
         return ida_idaapi.PLUGIN_KEEP
 
+    def _load_db(self):
+        try:
+            cache = set(self.db.keys())
+            # A/W aliases of documented names are only hit exactly, fuzzy search skips them
+            cache_lower = {name.lower(): name for name in self.db.keys(aliases=False)}
+            prefix_index = sorted(cache_lower)
+        except Exception as e:
+            ida_kernwin.msg(f'failed to load {DOC_DB_PATH}: {e}\n')
+        else:
+            self.cache, self.cache_lower, self.prefix_index = cache, cache_lower, prefix_index
+            self._loaded = True
+        finally:
+            self._ready.set()
+
     def run(self, arg):
+        self._ready.wait()
+        if not self._loaded:
+            ida_kernwin.msg('database failed to load\n')
+            return
+
         api_name = self.get_api_name()
         if not api_name:
             ida_kernwin.msg('description not found\n')
             return
 
         description = self.db[api_name]
-        widget = idaapi.find_widget(self.viewer.widget_name)
-        if widget:
-            idaapi.activate_widget(widget, True)
+        if self.viewer.widget is not None:
+            idaapi.activate_widget(self.viewer.widget, True)
         else:
             self.viewer.Show()
         self.viewer.Update(content=description)
@@ -143,16 +201,40 @@ class MSDNPlugin(ida_idaapi.plugin_t):
             return None
 
         if api_name not in self.cache:
-            matches = difflib.get_close_matches(api_name, self.cache)
+            lowered = api_name.lower()
+            if lowered in self.cache_lower:
+                return self.cache_lower[lowered]
+
+            matches, shortlisted = self.find_close_matches(lowered)
             if len(matches) == 0:
                 return None
-            elif len(matches) == 1:
+            elif len(matches) == 1 and not shortlisted:
                 return matches[0]
             else:
                 api_name = self.choose.Pick(matches)
 
         return api_name
 
+    def find_close_matches(self, lowered: str) -> tuple:
+        # shortlist names sharing the longest prefix that still leaves a choice (CreateFileW -> CreateFile*)
+        candidates = []
+        for length in range(len(lowered), MIN_PREFIX_LENGTH - 1, -1):
+            candidates = self.find_by_prefix(lowered[:length])
+            if len(candidates) >= SHORTLIST_SIZE:
+                break
+
+        # the shortlist only wins with a near-exact hit, a weaker one may hide a better match elsewhere
+        matches = difflib.get_close_matches(lowered, candidates)
+        shortlisted = bool(matches) and difflib.SequenceMatcher(None, lowered, matches[0]).ratio() >= SHORTLIST_CUTOFF
+        if not shortlisted:
+            matches = difflib.get_close_matches(lowered, self.prefix_index)
+        return [self.cache_lower[x] for x in matches], shortlisted
+
+    def find_by_prefix(self, prefix: str) -> list:
+        start = bisect.bisect_left(self.prefix_index, prefix)
+        end = bisect.bisect_left(self.prefix_index, prefix + '\uffff', start)
+        return self.prefix_index[start:end]
+
     @staticmethod
     def get_api_name_from_selection():
         v = ida_kernwin.get_current_viewer()
@@ -161,20 +243,17 @@ class MSDNPlugin(ida_idaapi.plugin_t):
             return None 
 
         name, _ = highlight
+        return MSDNPlugin.normalize_name(name)
 
-        # remove common prefixes
-        prefixes = [ida_name.FUNC_IMPORT_PREFIX, 'cs:', 'ds:', 'j_']
-        for prefix in prefixes:
-            if name.startswith(prefix):
-                name = name[len(prefix):]
-                break
-        
-        # select function call in decompiler view
-        pos = name.find('(')
-        if pos != -1:
-            name = name[:pos]
+    @staticmethod
+    def normalize_name(name: str) -> str:
+        # remove common prefix, one str.startswith call when there is none
+        if name.startswith(NAME_PREFIXES):
+            prefix = next(x for x in NAME_PREFIXES if name.startswith(x))
+            name = name[len(prefix):]
 
-        return name
+        # select function call in decompiler view
+        return name.partition('(')[0]
 
 
 plugin = MSDNPlugin()
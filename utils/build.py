@@ -3,10 +3,13 @@
 import argparse
 import collections
 import dataclasses
+import functools
+import json
 import logging
+import os
 import pathlib
 import re
-import pickle
+import sqlite3
 import typing
 import multiprocessing
 import zlib
@@ -17,21 +20,114 @@ docsets = [
     'windows-driver-docs-ddi/wdk-ddi-src/content',
 ]
 
+_TAG_RE = re.compile(r'\</?(a|div)[^\>]*\>')
+# whitespace runs that the cleanup may change: ones holding a line break or several spaces
+_WHITESPACE_RE = re.compile(r'[ \n\r]*[\n\r][ \n\r]*| {2,}')
+_SPACES_RE = re.compile(r' +')
+_NEWLINES_RE = re.compile(r'[\n\r]{2,}')
+_HDR_DASH_RE = re.compile(r'# -(.+)')
+_HDR_FUNC_RE = re.compile(r'# ([^\s]+) function')
+_SEE_ALSO_RE = re.compile(r'## See-also[^#]+')
+_LINK_RE = re.compile(r'\[([^\]]+)\]\([^\)]+\)')
+_TABLE_RE = re.compile(r'<table.*?</table>', re.DOTALL)
+_H3_RE = re.compile(r'<h3>([^<]+)</h3>')
+_FUNC_RE = re.compile(r'([^\s]+) function')
+_BORDERED_TABLE = '<table border="1" cellspacing="0" cellpadding="3">'
+
+# zlib window size, a longer preset dictionary would not be used
+ZDICT_SIZE = 32 * 1024
+# repeated lines replaced by a single unicode private use character
+INTERN_LIMIT = 4096
+PLACEHOLDERS = range(0xE000, 0xF900)
+
+
+def collect_fragments(texts: typing.Iterable[str], limit: int = INTERN_LIMIT) -> dict:
+    counter = collections.Counter()
+    charset = set()
+    for text in texts:
+        counter.update(text.split('\n'))
+        charset.update(text)
+
+    # bytes saved by the replacement, minus the fragment table entry itself
+    lines = sorted(
+        ((count * (len(line.encode('utf-8')) - 3) - len(line), line) for line, count in counter.items() if count > 1),
+        reverse=True,
+    )
+    placeholders = (chr(x) for x in PLACEHOLDERS if chr(x) not in charset)
+    return {line: placeholder for (saved, line), placeholder in zip(lines[:limit], placeholders) if saved > 0}
+
+
+def intern(text: str, fragments: dict) -> str:
+    return '\n'.join([fragments.get(line, line) for line in text.split('\n')])
+
 
-class DocsDBStore(collections.UserDict):
-    def __setitem__(self, key: str, value: str):
-        if not isinstance(value, str):
-            raise TypeError('Only string values allowed')
+def train_dictionary(texts: typing.Iterable[str], size: int = ZDICT_SIZE) -> bytes:
+    # lines shared between docs, the most valuable ones last (zlib is cheaper on nearer matches)
+    counter = collections.Counter()
+    for text in texts:
+        counter.update(set(text.split('\n')))
 
-        data = zlib.compress(value.encode())
-        return super().__setitem__(key, data)
+    lines = sorted(
+        ((count * len(line), line) for line, count in counter.items() if count > 1 and len(line) > 3),
+        reverse=True,
+    )
+    selected, total = [], 0
+    for _, line in lines:
+        data = line.encode('utf-8') + b'\n'
+        if total + len(data) <= size:
+            selected.append(data)
+            total += len(data)
+    return b''.join(reversed(selected))
+
+
+def compress(raw: bytes, zdict: bytes) -> bytes:
+    compressor = zlib.compressobj(level=9, zdict=zdict)
+    return compressor.compress(raw) + compressor.flush()
+
+
+def save(db: dict, filepath: str):
+    path = pathlib.Path(filepath)
+    if path.exists():
+        path.unlink()
+
+    # names with identical content share one blob
+    blob_ids = {}
+    names = [(name, blob_ids.setdefault(text, len(blob_ids))) for name, text in db.items()]
+
+    fragments = collect_fragments(blob_ids)
+    texts = [intern(text, fragments) for text in blob_ids]
+    zdict = train_dictionary(texts)
+    placeholders = {placeholder: line for line, placeholder in fragments.items()}
+
+    conn = sqlite3.connect(str(path))
+    conn.execute('CREATE TABLE meta(key TEXT PRIMARY KEY, value BLOB NOT NULL)')
+    conn.execute('CREATE TABLE blobs(id INTEGER PRIMARY KEY, blob BLOB NOT NULL)')
+    conn.execute(
+        'CREATE TABLE docs(name TEXT PRIMARY KEY, blob_id INTEGER NOT NULL REFERENCES blobs(id), '
+        'alias INTEGER NOT NULL DEFAULT 0)'
+    )
+    conn.execute("INSERT INTO meta(key, value) VALUES('zdict', ?)", (zdict,))
+    conn.execute(
+        "INSERT INTO meta(key, value) VALUES('fragments', ?)",
+        (zlib.compress(json.dumps(placeholders).encode('utf-8'), level=9),),
+    )
+    conn.executemany(
+        'INSERT INTO blobs(id, blob) VALUES(?, ?)',
+        ((blob_id, compress(text.encode('utf-8'), zdict)) for blob_id, text in enumerate(texts)),
+    )
+    conn.executemany('INSERT INTO docs(name, blob_id) VALUES(?, ?)', names)
 
-    def __getitem__(self):
-        raise NotImplementedError
+    # CreateFile -> CreateFileA, CreateFileW, unless they are documented on their own
+    for suffix in ('A', 'W'):
+        conn.execute(
+            "INSERT OR IGNORE INTO docs(name, blob_id, alias) "
+            "SELECT name || ?, blob_id, 1 FROM docs WHERE NOT alias AND substr(name, -1) NOT IN ('A', 'W')",
+            (suffix,),
+        )
 
-    def save(self, filepath: str) -> dict:
-        with open(filepath, 'wb') as handle:
-            return pickle.dump(self.data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
 
 
 @dataclasses.dataclass(frozen=True)
@@ -45,16 +141,53 @@ class ApiDoc(object):
 
     def __init__(self, filepath: str, force: bool = False):
         self._filepath = filepath
-        with open(self._filepath, "r", errors = "ignore") as infile:
-            data = infile.read()
-
-        _, front_matter, *markdown = data.split('---')
-        self.front_matter = front_matter
-        self.content = '---'.join(markdown)
+        with open(self._filepath, 'rb') as infile:
+            data = infile.read(4096)
+            # cheap rejection of non-function docs (enums, structures, etc.) before reading everything,
+            # only possible when the whole front matter fits in the head
+            start, end = self._find_front_matter(data)
+            if not force and end != -1 and not self._is_function_doc(data[start:end]):
+                raise ValueError(f'not a function doc in {self._filepath}')
+            data += infile.read()
+
+        start, end = self._find_front_matter(data)
+        if start == -1:
+            raise ValueError(f'front matter not found in {self._filepath}')
+        if end == -1:
+            # a lone delimiter, the rest of the file is front matter
+            end = len(data)
+
+        front_matter = data[start:end]
+        if not force and not self._is_function_doc(front_matter):
+            raise ValueError(f'not a function doc in {self._filepath}')
+
+        # only kept files are decoded
+        self.front_matter = self._decode(front_matter)
+        self.content = self._decode(data[end + 3:])
 
         if not force and not self.verify():
             raise ValueError(f'invalid file format in {self._filepath}')
 
+    @staticmethod
+    def _find_front_matter(data: bytes) -> tuple:
+        # same boundaries as data.split('---'): whatever precedes the first delimiter (BOM, blank lines) is dropped
+        start = data.find(b'---')
+        if start == -1:
+            return -1, -1
+        return start + 3, data.find(b'---', start + 3)
+
+    @staticmethod
+    def _is_function_doc(data: bytes) -> bool:
+        return b'title:' in data and b' function' in data
+
+    @staticmethod
+    def _decode(data: bytes) -> str:
+        # same result as reading the file in text mode
+        text = data.decode('utf-8', errors='ignore')
+        if '\r' in text:
+            text = text.replace('\r\n', '\n').replace('\r', '\n')
+        return text
+
     def verify(self) -> bool:
         name = self.name
         if not name:
@@ -72,62 +205,77 @@ class ApiDoc(object):
 
         return self.content
 
+    @staticmethod
+    def _squeeze_whitespace(match: re.Match) -> str:
+        text = _SPACES_RE.sub(' ', match.group())
+        if match.string.startswith('<', match.end()):
+            text = text.rstrip('\n\r')
+        text = _NEWLINES_RE.sub('\n\n', text)
+        return text.replace('\n ', ' ')
+
+    @staticmethod
+    def _fix_table(match: re.Match) -> str:
+        # widths go first, so that <table width="40%"> gets the borders too
+        text = ApiDoc._strip_widths(match.group().replace('\n\n', '\n'))
+        return text.replace('<table>', _BORDERED_TABLE)
+
+    @staticmethod
+    def _strip_widths(text: str) -> str:
+        return text.replace(' width="40%"', '').replace(' width="60%"', '')
+
     @staticmethod
     def _clean_markdown(text: str):
         # remove <a>, <div> tags
-        text = re.sub(r'\</?(a|div)[^\>]*\>', '', text)
+        text = _TAG_RE.sub('', text)
 
         # remove multiple enters and unnecessary spacing
-        text = re.sub(r' +', ' ', text)
-        text = re.sub(r'>[\n\r]+<', '><', text)
-        text = re.sub(r'[\n\r]+<', '<', text)
-        text = re.sub(r'[\n\r]{2,}', '\n\n', text)
-        text = text.replace('\n ', ' ')
+        text = _WHITESPACE_RE.sub(ApiDoc._squeeze_whitespace, text)
 
         # '## -description' -> '## Description'
-        text = re.sub(r'# -(.+)', lambda match: f'# {match.group(1).capitalize()}', text)
+        text = _HDR_DASH_RE.sub(lambda match: f'# {match.group(1).capitalize()}', text)
 
-        text = re.sub(r'# ([^\s]+) function', r'# \1', text)
+        text = _HDR_FUNC_RE.sub(r'# \1', text)
 
         # remove "See also" links section
-        text = re.sub(r'## See-also[^#]+', '', text, re.MULTILINE)
+        text = _SEE_ALSO_RE.sub('', text)
 
         # replace markdown links
-        text = re.sub(r'\[([^\]]+)\]\([^\)]+\)', r'**\g<1>**', text)
+        text = _LINK_RE.sub(r'**\g<1>**', text)
         
-        # fixing incorrect <table> margin from top 
-        offset = 0
-        while True:
-            start = text.find('<table', offset)
-            if start == -1:
-                break
-
-            end = text.find('</table>', start)
-            cleaned = text[start:end].replace('\n\n', '\n')
-            text = text[:start] + cleaned + text[end:]
-            offset = start + len(cleaned)
-
-        # table borders and columns width
-        text = text.replace(' width="40%"', '').replace(' width="60%"', '')
-        text = text.replace('<table>', '<table border="1" cellspacing="0" cellpadding="3">')
+        # fixing incorrect <table> margin from top, columns width, table borders
+        text = _TABLE_RE.sub(ApiDoc._fix_table, text)
+
+        # columns width and borders left outside of the pass above (tables without </table>)
+        text = ApiDoc._strip_widths(text)
+        if '<table>' in text:
+            text = text.replace('<table>', _BORDERED_TABLE)
 
         # replace h3 tag with markdown header
-        text = re.sub(r'<h3>([^<]+)</h3>', r'\n\n### \g<1>\n\n', text)
+        text = _H3_RE.sub(r'\n\n### \g<1>\n\n', text)
 
         return text
 
-    @property
-    def name(self):
-        match = re.search(r'title: (.*)', self.front_matter)
-        if match is None:
+    @functools.cached_property
+    def name(self) -> typing.Optional[str]:
+        # first 'title: ' anywhere, like re.search(r'title: (.*)') did
+        start = self.front_matter.find('title: ')
+        if start == -1:
             logging.debug(f"title is not present in {self._filepath}")
-            raise False
+            return None
+
+        start += len('title: ')
+        end = self.front_matter.find('\n', start)
+        title = self.front_matter[start:end if end != -1 else None]
+
+        head, separator, _ = title.partition(' function')
+        if separator and head and not head[-1].isspace():
+            return head.rsplit(None, 1)[-1].replace('\\', '')
 
-        title = match.group(1)
-        match = re.search(r'([^\s]+) function', title)
+        # the first ' function' is not preceded by a word, let the regex find a later one
+        match = _FUNC_RE.search(title)
         if not match:
             logging.debug(f"unsupported title format in {self._filepath}")
-            return False
+            return None
         return match.group(1).replace('\\', '')
 
     def __str__(self) -> str:
@@ -145,6 +293,16 @@ def parse_file(filepath: str) -> typing.Optional[FrozenApiDoc]:
     return None
 
 
+def iter_markdown_files(dirpath: str) -> typing.Generator[str, None, None]:
+    # DirEntry serves is_dir() and name from the directory listing, no extra stat() per file
+    with os.scandir(dirpath) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_markdown_files(entry.path)
+            elif entry.name.endswith('.md') and not entry.name.startswith('_'):
+                yield entry.path
+
+
 def parse_from_directory_iter(dirpath: str) -> typing.Generator[FrozenApiDoc, None, None]:
     _dirpath = pathlib.Path(dirpath)
 
@@ -154,9 +312,10 @@ def parse_from_directory_iter(dirpath: str) -> typing.Generator[FrozenApiDoc, No
         logging.warning(f"skipping {_dirpath}")
         return False
 
-    with multiprocessing.Pool() as pool:
-        files = filter(lambda x: not x.startswith('_'), map(str, _dirpath.rglob('*.md')))
-        for result in pool.map(parse_file, files):
+    # imap keeps the results ordered, so the later file still wins on duplicate names
+    with multiprocessing.Pool(maxtasksperchild=256) as pool:
+        files = iter_markdown_files(str(_dirpath))
+        for result in pool.imap(parse_file, files, chunksize=64):
             if result is not None:
                 yield result
 
@@ -194,7 +353,7 @@ def main():
     )
 
     logging.info("starting the parsing")
-    db = DocsDBStore()
+    db = {}
     for docset_path in docsets:
         path = str(pathlib.Path(args.dirpath) / docset_path)
         logging.info(f"parsing {path}")
@@ -207,7 +366,7 @@ def main():
         logging.error('no files was parsed, exit')
         exit(0)
 
-    db.save(args.output)
+    save(db, args.output)
     logging.info(f"saved to {args.output}")
     
 